@@ -5,16 +5,27 @@ Gradio aplikace, která promění dětské kresby na krásné obrázky
 pomocí AI generování obrázků (OpenAI nebo Gemini).
 """
 
+import asyncio
+import atexit
+import functools
+import hashlib
+import os
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
 import gradio as gr
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 from providers import get_provider
 
 # Předdefinované umělecké styly (český popisek, anglický klíč pro model)
-STYLES = [
+STYLES = (
     ("kreslený / animovaný", "cartoon/animated"),
     ("akvarelová malba", "watercolor painting"),
     ("olejomalba", "oil painting"),
@@ -30,26 +41,200 @@ STYLES = [
     ("styl Krteček (pohádka Zdeněk Miler)", "fairy tale Little Mole (Zdenek Miler)"),
     ("Josef Lada", "Josef Lada like"),
     ("Alfons Mucha", "Alfond Mucha like"),
-    
-]
+)
 
+# Předpočítané při importu: český popisek -> klíč a volby pro Dropdown
+STYLE_LABELS_TO_KEYS = {label: key for label, key in STYLES}
+STYLE_CHOICES = [(label, key) for label, key in STYLES]
 
-def transform_sketch(
-    sketch: Image.Image,
+# Největší rozměr, na který se při načítání zmenší velké fotky kreseb
+MAX_SKETCH_SIZE = 2048
+
+
+def load_sketch(sketch: Image.Image | str) -> Image.Image:
+    """
+    Načti kresbu z PIL obrázku nebo z cesty k nahranému souboru.
+
+    Velké fotky z mobilu zmenší na nejvýše MAX_SKETCH_SIZE. U JPEG
+    nechá dekodér obrázek zmenšit už při dekódování (Image.draft),
+    zbytek dopočítá LANCZOS s rychlým předzmenšením (reducing_gap).
+
+    Args:
+        sketch: PIL obrázek nebo cesta k souboru
+
+    Returns:
+        Načtený obrázek
+    """
+    if isinstance(sketch, Image.Image):
+        return sketch
+
+    img = Image.open(sketch)
+    # thumbnail sám volá draft a rozměry nikdy nezmenší pod 1 px
+    img.thumbnail(
+        (MAX_SKETCH_SIZE, MAX_SKETCH_SIZE),
+        Image.Resampling.LANCZOS,
+        reducing_gap=2.0,
+    )
+    # in_place: bez orientačního tagu nevzniká zbytečná kopie celého obrázku
+    ImageOps.exif_transpose(img, in_place=True)
+    return img
+
+
+# Kolik generování může běžet najednou (napříč všemi uživateli a tlačítky)
+MAX_CONCURRENT_GENERATIONS = 5
+_generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+
+# Cache vygenerovaných obrázků: (otisk kresby, styl, instrukce) -> data WebP
+RESULT_CACHE_SIZE = 16
+_result_cache: OrderedDict[tuple, bytes] = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# Soubory s výsledky pro Gradio. Gradio si je hned po vrácení zkopíruje
+# do své cache, a tak se mažou až se zpožděním (v sekundách)
+RESULT_FILE_MAX_AGE = 600
+_RESULT_DIR = tempfile.mkdtemp(prefix="kresba-na-obrazek-")
+atexit.register(shutil.rmtree, _RESULT_DIR, ignore_errors=True)
+
+# Tiskový layout: A4 při 150 DPI (dostatečné pro tisk, menší soubor)
+A4_WIDTH = 1240  # 210mm
+A4_HEIGHT = 1754  # 297mm
+MARGIN = 60
+LABEL_HEIGHT = 50
+SPACING = 40
+
+# Dostupný prostor pro každý z obou obrázků
+AVAILABLE_WIDTH = A4_WIDTH - 2 * MARGIN
+AVAILABLE_HEIGHT = (A4_HEIGHT - 2 * MARGIN - 2 * LABEL_HEIGHT - SPACING) // 2
+
+# Fonty pro popisky v tiskovém layoutu (macOS, Linux), použije se první dostupný
+LABEL_FONT_PATHS = (
+    "/System/Library/Fonts/Helvetica.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+)
+LABEL_FONT_SIZE = 36
+
+
+@functools.lru_cache(maxsize=None)
+def _load_label_font() -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    """Načti font pro popisky (jen jednou), jinak výchozí font."""
+    for path in LABEL_FONT_PATHS:
+        try:
+            return ImageFont.truetype(path, LABEL_FONT_SIZE)
+        except (OSError, IOError):
+            continue
+    return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=None)
+def _render_label(text: str) -> Image.Image:
+    """Vykresli popisek jednou do masky (L), která se pak jen vkládá na plátno."""
+    font = _load_label_font()
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (right, bottom), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+    return mask
+
+
+def encode_result(result: Image.Image) -> bytes:
+    """
+    Zakóduj vygenerovaný obrázek jako WebP.
+
+    Výsledek z AI je už ztrátový, bezeztrátové PNG (které by Gradio jinak
+    vytvořilo) by do prohlížeče posílalo zbytečně dvojnásobek dat.
+
+    Args:
+        result: Vygenerovaný obrázek
+
+    Returns:
+        Data obrázku ve formátu WebP
+    """
+    buffer = BytesIO()
+    result.save(buffer, format="WEBP", quality=90, method=4)
+    return buffer.getvalue()
+
+
+def _purge_result_files() -> None:
+    """Smaž soubory s výsledky starší než RESULT_FILE_MAX_AGE."""
+    cutoff = time.time() - RESULT_FILE_MAX_AGE
+    for entry in os.scandir(_RESULT_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def write_result(data: bytes) -> str:
+    """
+    Zapiš WebP data do nového dočasného souboru pro Gradio.
+
+    Každá odpověď dostane vlastní soubor, takže ho žádný souběžný
+    požadavek nesmaže dřív, než si ho Gradio zkopíruje.
+
+    Args:
+        data: Data obrázku ve formátu WebP
+
+    Returns:
+        Cesta k uloženému souboru
+    """
+    _purge_result_files()
+    with tempfile.NamedTemporaryFile(
+        dir=_RESULT_DIR, suffix=".webp", delete=False
+    ) as f:
+        f.write(data)
+    return f.name
+
+
+def _result_key(sketch_path: str, style: str, custom_prompt: str) -> tuple:
+    """
+    Klíč do cache výsledků: otisk nahraného souboru, styl a instrukce.
+
+    Soubor se hashuje přímo (komprimovaná data jsou mnohem menší než
+    pixely a při zásahu cache se kresba ani nemusí dekódovat).
+    SHA-256 z hashlib běží přes OpenSSL, které využívá instrukce SHA-NI.
+    """
+    with open(sketch_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    return (digest, style, custom_prompt.strip())
+
+
+def _cached_result(key: tuple) -> bytes | None:
+    """Vrať data dříve vygenerovaného obrázku pro stejné zadání."""
+    with _result_cache_lock:
+        data = _result_cache.get(key)
+        if data is not None:
+            _result_cache.move_to_end(key)
+        return data
+
+
+def _store_result(key: tuple, data: bytes) -> None:
+    """Zapamatuj si výsledek, nejstarší záznamy nad limit zahoď."""
+    with _result_cache_lock:
+        _result_cache[key] = data
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+
+async def transform_sketch(
+    sketch: Image.Image | str,
     style: str,
     custom_prompt: str,
     progress=gr.Progress(),
-) -> Image.Image:
+    use_cache: bool = True,
+) -> str:
     """
     Přeměň kresbu na obrázek ve zvoleném stylu.
 
     Args:
-        sketch: Vstupní kresba / obrázek
+        sketch: Vstupní kresba / obrázek (nebo cesta k souboru)
         style: Umělecký styl
         custom_prompt: Doplňující instrukce pro AI
+        use_cache: Vrátit dřívější výsledek pro stejné zadání, je-li k dispozici
 
     Returns:
-        Vygenerovaný obrázek
+        Cesta k vygenerovanému obrázku (WebP)
     """
     if sketch is None:
         raise gr.Error("Nejprve nahraj kresbu!")
@@ -57,27 +242,63 @@ def transform_sketch(
     if not style:
         raise gr.Error("Vyber styl!")
 
+    # Přijmi i český popisek místo klíče (např. při volání přes API)
+    style = STYLE_LABELS_TO_KEYS.get(style, style)
+
+    # Stejná kresba, styl i instrukce - není třeba znovu volat AI
+    # (jen pro nahrané soubory - PIL obrázky z UI nepřicházejí)
+    key = None
+    if isinstance(sketch, str):
+        key = await asyncio.to_thread(_result_key, sketch, style, custom_prompt)
+    if use_cache and key is not None:
+        cached = _cached_result(key)
+        if cached is not None:
+            path = await asyncio.to_thread(write_result, cached)
+            progress(1.0, desc="Hotovo!")
+            return path
+
+    # Dekódování a ukládání obrázků nesmí blokovat smyčku událostí
+    sketch = await asyncio.to_thread(load_sketch, sketch)
+
     progress(0.1, desc="Inicializuji AI...")
 
     try:
-        provider = get_provider("gemini")
+        provider = await asyncio.to_thread(get_provider, "gemini")
     except Exception as e:
         raise gr.Error(f"Nepodařilo se spustit poskytovatele: {e}")
 
     progress(0.3, desc=f"Vytvářím obrázek pomocí {provider.name}...")
 
     try:
-        result = provider.generate_from_sketch(
-            sketch=sketch,
-            style=style,
-            prompt=custom_prompt if custom_prompt.strip() else None,
-        )
+        # Sdílený limit pro obě tlačítka, každé má vlastní concurrency_limit
+        async with _generation_semaphore:
+            result = await provider.agenerate_from_sketch(
+                sketch=sketch,
+                style=style,
+                prompt=custom_prompt if custom_prompt.strip() else None,
+            )
+        data = await asyncio.to_thread(encode_result, result)
+        if key is not None:
+            _store_result(key, data)
+        path = await asyncio.to_thread(write_result, data)
         progress(1.0, desc="Hotovo!")
-        return result
+        return path
     except Exception as e:
         raise gr.Error(f"Generování obrázku selhalo: {e}")
 
 
+async def force_transform(
+    sketch: Image.Image | str,
+    style: str,
+    custom_prompt: str,
+    progress=gr.Progress(),
+) -> str:
+    """Přegeneruj obrázek bez ohledu na uložený výsledek (tlačítko Přegenerovat)."""
+    return await transform_sketch(
+        sketch, style, custom_prompt, progress, use_cache=False
+    )
+
+
 def create_print_layout(
     original: Image.Image, generated: Image.Image
 ) -> Image.Image:
@@ -91,50 +312,46 @@ def create_print_layout(
     Returns:
         Kompozitní obrázek pro tisk
     """
-    # A4 při 150 DPI (dostatečné pro tisk, menší soubor)
-    A4_WIDTH = 1240  # 210mm
-    A4_HEIGHT = 1754  # 297mm
-    MARGIN = 60
-    LABEL_HEIGHT = 50
-    SPACING = 40
-
     # Vytvoř bílé A4 plátno
     canvas = Image.new("RGB", (A4_WIDTH, A4_HEIGHT), "white")
-    draw = ImageDraw.Draw(canvas)
-
-    # Pokus se načíst systémový font, jinak výchozí
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 36)
-    except (OSError, IOError):
-        font = ImageFont.load_default()
-
-    # Vypočítej dostupný prostor pro každý obrázek
-    available_width = A4_WIDTH - 2 * MARGIN
-    available_height = (A4_HEIGHT - 2 * MARGIN - 2 * LABEL_HEIGHT - SPACING) // 2
 
     def resize_to_fit(img: Image.Image, max_w: int, max_h: int) -> Image.Image:
         """Změň velikost obrázku tak, aby se vešel do zadaného prostoru."""
+        # Plátno je RGB - převeď předem, ať se LANCZOS počítá jen přes 3 kanály
+        # (a paletové obrázky se nezmenšují metodou NEAREST)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
         ratio = min(max_w / img.width, max_h / img.height)
         new_size = (int(img.width * ratio), int(img.height * ratio))
-        return img.resize(new_size, Image.Resampling.LANCZOS)
+        if new_size == img.size:
+            return img
+        # reducing_gap: nejprve rychlé celočíselné zmenšení, pak LANCZOS
+        return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    # Zmenši oba obrázky souběžně (Pillow při změně velikosti uvolňuje GIL)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        orig_future = executor.submit(
+            resize_to_fit, original, AVAILABLE_WIDTH, AVAILABLE_HEIGHT
+        )
+        gen_future = executor.submit(
+            resize_to_fit, generated, AVAILABLE_WIDTH, AVAILABLE_HEIGHT
+        )
+        orig_resized, gen_resized = orig_future.result(), gen_future.result()
 
-    # Zpracuj originální obrázek
-    orig_resized = resize_to_fit(original, available_width, available_height)
-    orig_x = MARGIN + (available_width - orig_resized.width) // 2
+    # Umísti originální obrázek
+    orig_x = MARGIN + (AVAILABLE_WIDTH - orig_resized.width) // 2
     orig_y = MARGIN + LABEL_HEIGHT
 
-    # Zpracuj vygenerovaný obrázek
-    gen_resized = resize_to_fit(generated, available_width, available_height)
-    gen_x = MARGIN + (available_width - gen_resized.width) // 2
-    gen_y = MARGIN + LABEL_HEIGHT + available_height + SPACING + LABEL_HEIGHT
-
-    # Nakresli popisky
-    draw.text((MARGIN, MARGIN), "Originál:", fill="black", font=font)
-    draw.text(
-        (MARGIN, MARGIN + LABEL_HEIGHT + available_height + SPACING),
-        "Vygenerováno:",
-        fill="black",
-        font=font,
+    # Umísti vygenerovaný obrázek
+    gen_x = MARGIN + (AVAILABLE_WIDTH - gen_resized.width) // 2
+    gen_y = MARGIN + LABEL_HEIGHT + AVAILABLE_HEIGHT + SPACING + LABEL_HEIGHT
+
+    # Vlož popisky (předem vykreslené masky)
+    canvas.paste("black", (MARGIN, MARGIN), _render_label("Originál:"))
+    canvas.paste(
+        "black",
+        (MARGIN, MARGIN + LABEL_HEIGHT + AVAILABLE_HEIGHT + SPACING),
+        _render_label("Vygenerováno:"),
     )
 
     # Vlož obrázky
@@ -144,13 +361,15 @@ def create_print_layout(
     return canvas
 
 
-def print_images(original: Image.Image, generated: Image.Image) -> str:
+def print_images(
+    original: Image.Image | str, generated: Image.Image | str
+) -> str:
     """
     Vytiskni oba obrázky na výchozí tiskárně.
 
     Args:
-        original: Originální kresba
-        generated: Vygenerovaný obrázek
+        original: Originální kresba (nebo cesta k souboru)
+        generated: Vygenerovaný obrázek (nebo cesta k souboru)
 
     Returns:
         Zpráva o stavu tisku
@@ -162,20 +381,28 @@ def print_images(original: Image.Image, generated: Image.Image) -> str:
 
     try:
         # Vytvoř kompozitní obrázek
-        print_layout = create_print_layout(original, generated)
-
-        # Ulož do dočasného souboru
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
-            print_layout.save(f.name)
-            # Tisk pomocí výchozí tiskárny
-            result = subprocess.run(
-                ["lpr", f.name],
-                capture_output=True,
-                text=True,
-            )
-            if result.returncode != 0:
-                raise gr.Error(f"Tisk selhal: {result.stderr}")
-            return "Obrázek odeslán na tiskárnu!"
+        print_layout = create_print_layout(
+            load_sketch(original), load_sketch(generated)
+        )
+
+        # Tisk pomocí výchozí tiskárny - lpr čte data ze standardního vstupu,
+        # PNG se tedy posílá rovnou rourou bez dočasného souboru.
+        # Nízká komprese: pro tiskovou frontu na velikosti nezáleží, kódování je rychlé.
+        proc = subprocess.Popen(
+            ["lpr"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            print_layout.save(proc.stdin, format="PNG", compress_level=1)
+        except BrokenPipeError:
+            pass  # lpr skončil předčasně, chybu nahlásí jeho návratový kód
+        # communicate zavře stdin a počká na dokončení lpr
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise gr.Error(f"Tisk selhal: {stderr.decode(errors='replace')}")
+        return "Obrázek odeslán na tiskárnu!"
     except FileNotFoundError:
         raise gr.Error("Příkaz 'lpr' nenalezen. Je tiskárna nastavena?")
     except Exception as e:
@@ -206,13 +433,13 @@ def create_app() -> gr.Blocks:
                 # Vstupní část
                 sketch_input = gr.Image(
                     label="Nahraj svou kresbu",
-                    type="pil",
+                    type="filepath",
                     sources=["upload", "clipboard"],
                     height=400,
                 )
 
                 style_dropdown = gr.Dropdown(
-                    choices=STYLES,
+                    choices=STYLE_CHOICES,
                     value=STYLES[0][1],
                     label="Vyber styl",
                     info="Vyber, jak se má kresba proměnit",
@@ -234,7 +461,8 @@ def create_app() -> gr.Blocks:
                 # Výstupní část
                 output_image = gr.Image(
                     label="Vygenerovaný obrázek",
-                    type="pil",
+                    type="filepath",
+                    format="webp",
                     height=400,
                 )
 
@@ -268,6 +496,7 @@ def create_app() -> gr.Blocks:
             fn=transform_sketch,
             inputs=[sketch_input, style_dropdown, custom_prompt],
             outputs=output_image,
+            concurrency_limit=MAX_CONCURRENT_GENERATIONS,
         )
 
         print_btn.click(
@@ -280,9 +509,10 @@ def create_app() -> gr.Blocks:
         )
 
         regenerate_btn.click(
-            fn=transform_sketch,
+            fn=force_transform,
             inputs=[sketch_input, style_dropdown, custom_prompt],
             outputs=output_image,
+            concurrency_limit=MAX_CONCURRENT_GENERATIONS,
         )
 
     return app
@@ -294,7 +524,7 @@ def main():
     app.launch(
         share=True,
         show_error=True,
-        max_threads=5,
+        max_threads=MAX_CONCURRENT_GENERATIONS,
         theme=gr.themes.Soft(
             primary_hue="blue",
             secondary_hue="purple",
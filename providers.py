@@ -3,8 +3,10 @@ Image generation providers with a common interface.
 Supports easy switching between different AI image generation APIs.
 """
 
+import asyncio
 import base64
 import os
+import threading
 from abc import ABC, abstractmethod
 from io import BytesIO
 from typing import Protocol
@@ -12,6 +14,45 @@ from typing import Protocol
 from PIL import Image
 
 
+def _downscale(img: Image.Image, max_size: int) -> Image.Image:
+    """Shrink the image to fit into max_size x max_size (never upscales)."""
+    ratio = max_size / max(img.width, img.height)
+    if ratio >= 1:
+        return img
+    new_size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    # reducing_gap does a cheap integer box reduce before the LANCZOS pass
+    return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+
+def _encode_sketch(sketch: Image.Image) -> tuple[str, BytesIO, str]:
+    """
+    Encode a sketch for upload.
+
+    Photos and scans of drawings are sent as JPEG, which is several times
+    smaller than PNG. Only sketches with real transparency are kept as PNG
+    (with fast, light compression). The buffer is returned rewound rather
+    than copied out, so file-like upload APIs can stream it directly.
+
+    Returns:
+        Tuple of (filename, encoded buffer, mime type)
+    """
+    img_buffer = BytesIO()
+    if "A" in sketch.getbands() or "transparency" in sketch.info:
+        # Check the alpha band in place, convert only palette/transparency images
+        rgba = sketch if sketch.mode in ("RGBA", "LA") else sketch.convert("RGBA")
+        if rgba.getchannel("A").getextrema()[0] < 255:
+            rgba.save(img_buffer, format="PNG", compress_level=1)
+            img_buffer.seek(0)
+            return "sketch.png", img_buffer, "image/png"
+
+    # JPEG stores grayscale directly, no need to expand it to RGB
+    if sketch.mode not in ("RGB", "L"):
+        sketch = sketch.convert("RGB")
+    sketch.save(img_buffer, format="JPEG", quality=90, optimize=False, progressive=False)
+    img_buffer.seek(0)
+    return "sketch.jpg", img_buffer, "image/jpeg"
+
+
 class ImageProvider(ABC):
     """Abstract base class for image generation providers."""
 
@@ -35,6 +76,17 @@ class ImageProvider(ABC):
         """
         pass
 
+    async def agenerate_from_sketch(
+        self, sketch: Image.Image, style: str, prompt: str | None = None
+    ) -> Image.Image:
+        """
+        Async variant of generate_from_sketch.
+
+        Runs the synchronous implementation in a worker thread by default;
+        providers with an async client can override it.
+        """
+        return await asyncio.to_thread(self.generate_from_sketch, sketch, style, prompt)
+
     def _build_prompt(self, style: str, prompt: str | None = None) -> str:
         """Build the full prompt for image generation."""
         base_prompt = (
@@ -53,6 +105,9 @@ class OpenAIProvider(ImageProvider):
     name = "OpenAI GPT-Image-1.5"
     description = "OpenAI's latest image generation model with excellent sketch interpretation"
 
+    # Output size requested from the API; larger sketches are shrunk to match
+    IMAGE_SIZE = 1024
+
     def __init__(self, api_key: str | None = None, model: str = "gpt-image-1.5"):
         """
         Initialize the OpenAI provider.
@@ -70,24 +125,22 @@ class OpenAIProvider(ImageProvider):
         self, sketch: Image.Image, style: str, prompt: str | None = None
     ) -> Image.Image:
         """Generate image using OpenAI's image edit API."""
-        # Convert PIL Image to bytes with proper format
-        img_buffer = BytesIO()
-        # Ensure image is in RGB mode for PNG
-        if sketch.mode == "RGBA":
-            sketch = sketch.convert("RGB")
-        sketch.save(img_buffer, format="PNG")
-        img_bytes = img_buffer.getvalue()
+        # No point uploading more pixels than the generated image has
+        sketch = _downscale(sketch, self.IMAGE_SIZE)
+
+        filename, img_buffer, mime_type = _encode_sketch(sketch)
 
         full_prompt = self._build_prompt(style, prompt)
 
         # Use the images.edit endpoint for sketch transformation
-        # Pass as tuple with filename and mime type for proper detection
+        # Pass as tuple with filename and mime type for proper detection;
+        # the SDK streams file-like objects without copying them to bytes
         response = self.client.images.edit(
             model=self.model,
-            image=("sketch.png", img_bytes, "image/png"),
+            image=(filename, img_buffer, mime_type),
             prompt=full_prompt,
             n=1,
-            size="1024x1024",
+            size=f"{self.IMAGE_SIZE}x{self.IMAGE_SIZE}",
         )
 
         # Decode the base64 response
@@ -101,6 +154,9 @@ class GeminiVertexProvider(ImageProvider):
     name = "Gemini 3 Pro Image (Vertex AI)"
     description = "Google's Gemini model with Nano Banana image generation via Vertex AI"
 
+    # Default (1K) output size; larger sketches are shrunk to match before upload
+    IMAGE_SIZE = 1024
+
     def __init__(
         self,
         project: str | None = None,
@@ -130,24 +186,36 @@ class GeminiVertexProvider(ImageProvider):
         self._config_class = GenerateContentConfig
         self._modality = Modality
 
-    def generate_from_sketch(
+    def _request_args(
         self, sketch: Image.Image, style: str, prompt: str | None = None
-    ) -> Image.Image:
-        """Generate image using Gemini's multimodal capabilities."""
-        from google.genai.types import GenerateContentConfig, Modality
+    ) -> dict:
+        """Build generate_content arguments for a sketch transformation."""
+        from google.genai.types import GenerateContentConfig, Modality, Part
 
         full_prompt = self._build_prompt(style, prompt)
 
-        # Gemini accepts PIL Images directly
-        response = self.client.models.generate_content(
-            model=self.model,
-            contents=[sketch, full_prompt],
-            config=GenerateContentConfig(
+        # No point uploading more pixels than the generated image has
+        sketch = _downscale(sketch, self.IMAGE_SIZE)
+
+        # Encode once ourselves (JPEG, or fast PNG only with transparency)
+        # instead of letting the SDK pick a format and compression level.
+        # Part needs real bytes (memoryview is rejected); getvalue() on an
+        # unexported BytesIO hands over its internal buffer without a copy,
+        # unlike read()
+        _, img_buffer, mime_type = _encode_sketch(sketch)
+        sketch_part = Part.from_bytes(data=img_buffer.getvalue(), mime_type=mime_type)
+
+        return {
+            "model": self.model,
+            "contents": [sketch_part, full_prompt],
+            "config": GenerateContentConfig(
                 response_modalities=[Modality.TEXT, Modality.IMAGE],
             ),
-        )
+        }
 
-        # Extract the image from the response
+    @staticmethod
+    def _extract_image(response) -> Image.Image:
+        """Extract the generated image from a generate_content response."""
         for part in response.candidates[0].content.parts:
             if part.inline_data is not None:
                 image_data = part.inline_data.data
@@ -155,6 +223,24 @@ class GeminiVertexProvider(ImageProvider):
 
         raise RuntimeError("No image was generated in the response")
 
+    def generate_from_sketch(
+        self, sketch: Image.Image, style: str, prompt: str | None = None
+    ) -> Image.Image:
+        """Generate image using Gemini's multimodal capabilities."""
+        response = self.client.models.generate_content(
+            **self._request_args(sketch, style, prompt)
+        )
+        return self._extract_image(response)
+
+    async def agenerate_from_sketch(
+        self, sketch: Image.Image, style: str, prompt: str | None = None
+    ) -> Image.Image:
+        """Generate image using the async Gemini client (no thread per request)."""
+        # Encoding the sketch is CPU work, keep it off the event loop
+        request_args = await asyncio.to_thread(self._request_args, sketch, style, prompt)
+        response = await self.client.aio.models.generate_content(**request_args)
+        return self._extract_image(response)
+
 
 # Registry of available providers
 PROVIDERS: dict[str, type[ImageProvider]] = {
@@ -162,14 +248,25 @@ PROVIDERS: dict[str, type[ImageProvider]] = {
     "gemini": GeminiVertexProvider,
 }
 
+# Initialized providers per (name, kwargs), shared by all requests
+_provider_instances: dict[tuple, ImageProvider] = {}
+_provider_lock = threading.Lock()
+
 
 def get_provider(name: str, **kwargs) -> ImageProvider:
     """
     Get an initialized provider by name.
 
+    Instances are cached per (name, kwargs), so the SDK client (credential
+    discovery, Vertex AI metadata probes) is only set up on first use.
+    Construction happens under a lock, so concurrent first calls share one
+    instance. Failed initialization is not cached and is retried on the
+    next call.
+
     Args:
         name: Provider name (e.g., "openai", "gemini")
         **kwargs: Additional arguments passed to the provider constructor
+            (must be hashable)
 
     Returns:
         Initialized provider instance
@@ -178,7 +275,11 @@ def get_provider(name: str, **kwargs) -> ImageProvider:
         available = ", ".join(PROVIDERS.keys())
         raise ValueError(f"Unknown provider: {name}. Available: {available}")
 
-    return PROVIDERS[name](**kwargs)
+    key = (name, frozenset(kwargs.items()))
+    with _provider_lock:
+        if key not in _provider_instances:
+            _provider_instances[key] = PROVIDERS[name](**kwargs)
+        return _provider_instances[key]
 
 
 def list_providers() -> list[tuple[str, str, str]]: